@@ -1,4 +1,3 @@
-import time
 import subprocess
 from pathlib import Path
 import os
@@ -8,9 +7,73 @@ from queue import Queue
 import pandas as pd
 import sys
 import threading
+from concurrent.futures import ThreadPoolExecutor
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+# DIANNHandler keyword, job_data key and default for each DIA-NN search parameter
+DIANN_JOB_PARAMS = (
+    ('max_missed_cleavage', 'missed_cleavage', '1'),
+    ('max_var_mods', 'max_var_mods', '2'),
+    ('NtermMex_mod', 'mod_nterm_m_excision', True),
+    ('CCarb_mod', 'mod_c_carb', True),
+    ('OxM_mod', 'mod_ox_m', True),
+    ('AcNterm_mod', 'mod_ac_nterm', False),
+    ('Phospho_mod', 'mod_phospho', False),
+    ('KGG_mod', 'mod_k_gg', False),
+    ('peptide_length_range_min', 'peptide_length_min', '7'),
+    ('peptide_length_range_max', 'peptide_length_max', '30'),
+    ('precursor_charge_range_min', 'precursor_charge_min', '2'),
+    ('precursor_charge_range_max', 'precursor_charge_max', '4'),
+    ('precursor_min', 'precursor_min', '390'),
+    ('precursor_max', 'precursor_max', '1050'),
+    ('fragment_min', 'fragment_min', '200'),
+    ('fragment_max', 'fragment_max', '1800'),
+    ('threads', 'threads', '20'),
+    ('MBR', 'mbr', False),
+)
+
+# DIA-NN arguments added for each enabled variable modification, in command order
+DIANN_VAR_MOD_ARGS = (
+    ('OxM_mod', ('--var-mod', 'UniMod:35,15.994915,M')),
+    ('AcNterm_mod', ('--var-mod', 'UniMod:1,42.010565,*n', '--monitor-mod', 'UniMod:1')),
+    ('Phospho_mod', ('--var-mod', 'UniMod:21,79.966331,STY', '--monitor-mod', 'UniMod:21')),
+    ('KGG_mod', ('--var-mod', 'UniMod:121,114.042927,K', '--monitor-mod', 'UniMod:121',
+                 '--no-cut-after-mod', 'UniMod:121')),
+)
+
+# MSConvert options shared by every conversion run
+MSCONVERT_ARGS = (
+    "--zlib",
+    "--filter", "peakPicking vendor msLevel=1-",
+    "--filter",
+    "titleMaker <RunId>.<ScanNumber>.<ScanNumber>.<ChargeState> File:\"\"\"^<SourcePath^>\"\"\", NativeID:\"\"\"^<Id^>\"\"\"",
+)
+
+# Log level for each progress message prefix; anything unlisted (DIA-NN output, and the
+# STARTING / PROCESS COMPLETED lines the app's progress callback logs itself) is DEBUG
+PROGRESS_LOG_LEVELS = (
+    ("ERROR", logging.ERROR),
+    ("WARNING", logging.WARNING),
+    ("STEP COMPLETED", logging.INFO),
+    ("PROCESS CANCELLED", logging.INFO),
+)
+
+
+def _discard_progress(message):
+    """Progress callback used when the caller doesn't supply one"""
 
 
 class DIANNHandler:
+    # Write buffer for diann_log.txt
+    LOG_BUFFER_SIZE = 64 * 1024
+    # Upper bound on MSConvert processes run side by side
+    MSCONVERT_MAX_PARALLEL = 4
+    # Seconds between checks for a stop.sentinel file written by another process
+    SENTINEL_POLL_INTERVAL = 1
+
     def __init__(self,
                  diann_exe,
                  fasta,
@@ -35,7 +98,8 @@ class DIANNHandler:
                  fragment_min="200",
                  fragment_max="1800",
                  threads="20",
-                 MBR=False):
+                 MBR=False,
+                 stop_event=None):
         """
         Initialize the DIA-NN handler
 
@@ -64,15 +128,24 @@ class DIANNHandler:
             fragment_max: Maximum fragment m/z
             threads: Number of threads to use
             MBR: Whether to enable match between runs
+            stop_event: threading.Event that cancels the workflow when set
         """
         self.diann_exe = diann_exe
         self.use_mzML = True if msconvert_path else False
         self.msconvert_path = msconvert_path
         self.op_folder = op_folder
+        self.op_path = Path(op_folder)
         self.conditions = conditions
         self.progress_callback = progress_callback
+        # Bound once so log_progress doesn't need to test for a missing callback
+        self._progress = progress_callback or _discard_progress
+        self._progress_queue = Queue()
+        self._progress_thread = None
         self.conditions_dict = {}
         self.stop_requested = False
+        self.stop_event = stop_event or threading.Event()
+        self._active_processes = set()
+        self._workflow_done = threading.Event()
 
         # DIA-NN parameters
         self.max_missed_cleavage = max_missed_cleavage
@@ -96,36 +169,75 @@ class DIANNHandler:
 
         # Setup the diann plotter path
         diann_parent = Path(self.diann_exe).parent.absolute()
-        self.diann_plotter = Path(diann_parent) / 'dia-nn-plotter.exe'
+        self.diann_plotter = diann_parent / 'dia-nn-plotter.exe'
 
         # Setup the mzML folder
-        self.mzml_folder = Path(self.op_folder) / 'mzML_folder'
+        self.mzml_folder = self.op_path / 'mzML_folder'
         self.fasta = fasta
         self.predicted_library = None
 
         # Setup the output files
         self.diann_config = None
         self.sentinel_file = None
+        self._sentinel_path = None
         self.log_file = None
         self.error_flag = False
 
-    def log_progress(self, message):
-        """Log progress to the callback or print to console"""
-        if self.progress_callback:
-            self.progress_callback(message)
-        print(message)
+    def log_progress(self, message, *args):
+        """Log progress to the callback and the module logger
+
+        Any extra args are %-formatted into message, so call sites in the
+        output loops don't build the string up front. The log level comes from
+        the message prefix, see PROGRESS_LOG_LEVELS.
+        """
+        self._progress(message % args if args else message)
+        level = next((level for prefix, level in PROGRESS_LOG_LEVELS if message.startswith(prefix)),
+                     logging.DEBUG)
+        logger.log(level, message, *args)
+
+    def start_progress_thread(self):
+        """Hand progress messages to the callback from a dedicated thread
+
+        Keeps a slow callback (file writes, UI updates) from stalling the
+        workflow and its subprocess monitoring.
+        """
+        if self.progress_callback is None or self._progress_thread is not None:
+            return
+        self._progress = self._progress_queue.put
+        self._progress_thread = threading.Thread(target=self._deliver_progress, daemon=True)
+        self._progress_thread.start()
+
+    def stop_progress_thread(self):
+        """Deliver any queued progress messages and stop the progress thread"""
+        if self._progress_thread is None:
+            return
+        self._progress = self.progress_callback
+        self._progress_queue.put(None)
+        self._progress_thread.join()
+        self._progress_thread = None
+
+    def _deliver_progress(self):
+        while True:
+            message = self._progress_queue.get()
+            if message is None:
+                break
+            try:
+                self.progress_callback(message)
+            except Exception:
+                logger.exception("DIA-NN progress callback failed")
 
     def make_output_folder(self):
         """Create the output folder if it doesn't exist"""
-        if not Path(self.op_folder).exists():
-            Path(self.op_folder).mkdir(parents=True, exist_ok=True)
+        if not self.op_path.exists():
+            self.op_path.mkdir(parents=True, exist_ok=True)
             self.log_progress(f"Created output folder: {self.op_folder}")
 
     def make_output_files(self):
         """Setup output file paths"""
-        self.diann_config = Path(self.op_folder) / "diann_config.txt"
-        self.sentinel_file = Path(self.op_folder) / "stop.sentinel"
-        self.log_file = Path(self.op_folder) / "runtime_log.log"
+        self.diann_config = self.op_path / "diann_config.txt"
+        self.sentinel_file = self.op_path / "stop.sentinel"
+        self._sentinel_path = os.fspath(self.sentinel_file)
+        self.log_file = self.op_path / "runtime_log.log"
         self.log_progress(f"Output files will be created in: {self.op_folder}")
 
     def make_conditions_dict(self):
@@ -160,7 +272,7 @@ class DIANNHandler:
         if not all(str(Path(x)).startswith(('/', 'C:', 'D:')) for x in conditions_df['Raw file']):
             # These are just filenames, not full paths
             self.log_progress("Converting relative paths to absolute paths")
-            raw_folder = Path(self.op_folder) / "raw_files"
+            raw_folder = self.op_path / "raw_files"
             raw_folder.mkdir(exist_ok=True, parents=True)
             conditions_df['Full raw path'] = conditions_df['Raw file'].apply(
                 lambda x: str(raw_folder / Path(x).name)
@@ -171,7 +283,7 @@ class DIANNHandler:
 
         # Add column for mzML files
         conditions_df['Full mzML path'] = conditions_df['Basename'].apply(
-            lambda x: str(Path(self.mzml_folder) / f'{x}.mzML')
+            lambda x: str(self.mzml_folder / f'{x}.mzML')
         )
 
         # Convert the dataframe to a dictionary with 'basename' as keys
@@ -183,9 +295,44 @@ class DIANNHandler:
         self.log_progress(f"Processed {len(self.conditions_dict)} samples from conditions file")
         return True
 
+    def request_stop(self):
+        """Cancel the workflow, killing the external processes it is waiting on"""
+        self.stop_event.set()
+        for process in list(self._active_processes):
+            self.terminate_external_processes(process)
+
+    def watch_sentinel_file(self):
+        """Turn a set stop_event or a stop.sentinel file into request_stop()
+
+        Runs on its own thread for the length of the workflow, so a caller
+        setting stop_event also kills the external process a step is blocked
+        on, and the stop checks in the workflow itself only look at stop_event.
+        """
+        while not self._workflow_done.is_set():
+            if (self.stop_event.wait(self.SENTINEL_POLL_INTERVAL)
+                    or os.path.exists(self._sentinel_path)):
+                self.request_stop()
+                return
+
+    def wait_for_process(self, process):
+        """Wait for an external process to exit or for the workflow to be stopped
+
+        request_stop() kills the process registered here, so the wait ends as
+        soon as either happens. Returns False if the workflow was stopped.
+        """
+        self._active_processes.add(process)
+        try:
+            if self.check_for_stop_signal(process):
+                return False
+            process.wait()
+            # The process has exited, possibly because a stop killed it
+            return not self.check_for_stop_signal()
+        finally:
+            self._active_processes.discard(process)
+
     def check_for_stop_signal(self, subprocess_handle=None):
         """Check if a stop was requested and handle accordingly"""
-        if Path(self.sentinel_file).exists():
+        if self.stop_event.is_set():
             self.stop_requested = True
             self.log_progress("PROCESS CANCELLED: DIA-NN handler cancelled.")
 
@@ -248,55 +395,64 @@ class DIANNHandler:
             self.error_flag = True
             return False
 
-        # All raw files exist, convert them to mzML
+        # All raw files exist, convert them all: an existing mzML may be a partial one left by a stopped or failed run
         try:
-            BASE_COMMAND = [
-                "--zlib",
-                "--outdir", f'{str(self.mzml_folder)}',
-                "--filter", "peakPicking vendor msLevel=1-",
-                "--filter",
-                "titleMaker <RunId>.<ScanNumber>.<ScanNumber>.<ChargeState> File:\"\"\"^<SourcePath^>\"\"\", NativeID:\"\"\"^<Id^>\"\"\""
-            ]
-
-            command = [str(Path(self.msconvert_path))] + BASE_COMMAND + raw_files
-
-            self.log_progress(f"Running MSConvert: {' '.join(command[:5])}...")
-
-            with subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                                  text=True, bufsize=1, universal_newlines=True) as msconvert_process:
-
-                # Monitor the process
-                while msconvert_process.poll() is None:
-                    # Check for stop signal every 5 seconds
-                    if self.check_for_stop_signal(msconvert_process):
-                        return False
-
-                    time.sleep(5)
-
-                # Get final output
-                stdout, stderr = msconvert_process.communicate()
-
-                if msconvert_process.returncode == 0:
-                    self.log_progress("STEP COMPLETED: Files converted to mzML format.")
-                    return True
-                else:
-                    self.log_progress(f"ERROR: MSConvert failed with return code {msconvert_process.returncode}")
-                    self.log_progress(f"Stderr: {stderr}")
-                    self.error_flag = True
-                    return False
+            base_command = [str(Path(self.msconvert_path)), "--outdir", str(self.mzml_folder), *MSCONVERT_ARGS]
+
+            try:
+                max_parallel = min(self.MSCONVERT_MAX_PARALLEL, int(self.threads))
+            except (TypeError, ValueError):
+                max_parallel = self.MSCONVERT_MAX_PARALLEL
+
+            # MSConvert works through its inputs one at a time, so split them across parallel runs
+            num_batches = max(1, min(max_parallel, len(raw_files)))
+            commands = [base_command + raw_files[i::num_batches] for i in range(num_batches)]
+
+            self.log_progress(f"Running MSConvert on {len(raw_files)} files in {num_batches} parallel batches")
+
+            with ThreadPoolExecutor(max_workers=num_batches) as executor:
+                results = list(executor.map(self._run_msconvert_batch, commands))
+
+            if self.check_for_stop_signal():
+                return False
+
+            failures = [(returncode, stderr) for returncode, stderr in results if returncode != 0]
+            if not failures:
+                self.log_progress("STEP COMPLETED: Files converted to mzML format.")
+                return True
+            else:
+                for returncode, stderr in failures:
+                    self.log_progress(f"ERROR: MSConvert failed with return code {returncode}")
+                    self.log_progress("Stderr: %s", stderr)
+                self.error_flag = True
+                return False
 
         except Exception as e:
             self.log_progress(f"ERROR: Exception during MSConvert: {str(e)}")
             self.error_flag = True
             return False
 
+    def _run_msconvert_batch(self, command):
+        """Run one MSConvert process to completion and return (returncode, stderr)"""
+        with subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                              text=True) as msconvert_process:
+            self._active_processes.add(msconvert_process)
+            try:
+                # A stop may have arrived before the process was registered
+                if self.stop_event.is_set():
+                    self.terminate_external_processes(msconvert_process)
+                _, stderr = msconvert_process.communicate()
+            finally:
+                self._active_processes.discard(msconvert_process)
+        return msconvert_process.returncode, stderr
+
     def write_diann_command(self):
         """Generate the DIA-NN command configuration file"""
         self.log_progress("Preparing DIA-NN configuration")
 
         # Get input files
         if self.use_mzML:
-            input_files = [str(file) for file in Path(self.mzml_folder).glob("*.mzML")]
+            input_files = [str(file) for file in self.mzml_folder.glob("*.mzML")]
             if not input_files:
                 self.log_progress("ERROR: No mzML files found")
                 self.error_flag = True
@@ -305,8 +461,8 @@ class DIANNHandler:
             input_files = [details['Full raw path'] for details in self.conditions_dict.values()]
 
         # Define output paths
-        report_file = Path(self.op_folder) / 'report.tsv'
-        lib_file = Path(self.op_folder) / 'report-lib.tsv'
+        report_file = self.op_path / 'report.tsv'
+        lib_file = self.op_path / 'report-lib.tsv'
         fasta_file = Path(self.fasta)
 
         # Start building the command list
@@ -359,18 +515,9 @@ class DIANNHandler:
         # Add variable modifications
         command.extend(['--var-mods', str(self.max_var_mods)])
 
-        if self.OxM_mod:
-            command.extend(['--var-mod', 'UniMod:35,15.994915,M'])
-
-        if self.AcNterm_mod:
-            command.extend(['--var-mod', 'UniMod:1,42.010565,*n', '--monitor-mod', 'UniMod:1'])
-
-        if self.Phospho_mod:
-            command.extend(['--var-mod', 'UniMod:21,79.966331,STY', '--monitor-mod', 'UniMod:21'])
-
-        if self.KGG_mod:
-            command.extend(['--var-mod', 'UniMod:121,114.042927,K', '--monitor-mod', 'UniMod:121', '--no-cut-after-mod',
-                            'UniMod:121'])
+        for mod_attr, mod_args in DIANN_VAR_MOD_ARGS:
+            if getattr(self, mod_attr):
+                command.extend(mod_args)
 
         # Add match between runs if enabled
         if self.MBR:
@@ -402,7 +549,7 @@ class DIANNHandler:
 
             # Build the command
             command_list = self.build_diann_command()
-            self.log_progress(f"Running DIA-NN command: {command_list}")
+            self.log_progress("Running DIA-NN command: %s", command_list)
 
             # Start the subprocess
             diann_process = subprocess.Popen(
@@ -414,31 +561,38 @@ class DIANNHandler:
                 universal_newlines=True
             )
 
+            # Register the process so request_stop() can kill it mid-read
+            self._active_processes.add(diann_process)
+
             # Create a log file for the output
-            log_path = Path(self.op_folder) / "diann_log.txt"
-            with open(log_path, 'w') as log_file:
-                # Monitor the process
-                while diann_process.poll() is None:
-                    # Read from stdout
-                    output = diann_process.stdout.readline()
-                    if output:
-                        output = output.strip()
-                        self.log_progress(f"DIA-NN: {output}")
-                        log_file.write(f"{output}\n")
-                        log_file.flush()
-
-                    # Check for stop signal every few seconds
-                    if self.check_for_stop_signal(diann_process):
-                        return False
-
-                    time.sleep(0.1)
-
-                # Get any remaining output
-                stdout, stderr = diann_process.communicate()
-                if stdout:
-                    log_file.write(stdout)
-                if stderr:
-                    log_file.write(f"\nERRORS:\n{stderr}")
+            log_path = self.op_path / "diann_log.txt"
+            try:
+                # Lines already reach the progress callback as they arrive, so the
+                # file copy can be written in large blocks rather than flushed per line
+                with open(log_path, 'w', buffering=self.LOG_BUFFER_SIZE) as log_file:
+                    # Monitor the process
+                    while diann_process.poll() is None:
+                        # Read from stdout
+                        output = diann_process.stdout.readline()
+                        if output:
+                            output = output.strip()
+                            self.log_progress("DIA-NN: %s", output)
+                            log_file.write(f"{output}\n")
+
+                        # Check for stop signal every few seconds
+                        if self.check_for_stop_signal(diann_process):
+                            return False
+
+                        self.stop_event.wait(0.1)
+
+                    # Get any remaining output
+                    stdout, stderr = diann_process.communicate()
+                    if stdout:
+                        log_file.write(stdout)
+                    if stderr:
+                        log_file.write(f"\nERRORS:\n{stderr}")
+            finally:
+                self._active_processes.discard(diann_process)
 
             if diann_process.returncode == 0:
                 self.log_progress("STEP COMPLETED: DIA-NN search completed successfully")
@@ -456,23 +610,23 @@ class DIANNHandler:
     def run_diann_plotter(self):
         """Run the DIA-NN plotter to generate visualization reports"""
         # Check if the plotter executable exists
-        if not Path(self.diann_plotter).exists():
+        if not self.diann_plotter.exists():
             self.log_progress("WARNING: DIA-NN plotter not found, skipping visualization")
             return True
 
         self.log_progress("STARTING: Running DIA-NN plotter for visualization")
 
         try:
-            report_tsv = Path(self.op_folder) / 'report.tsv'
-            stats_file = Path(self.op_folder) / 'report.stats.tsv'
-            pdf_output = Path(self.op_folder) / 'report.pdf'
+            report_tsv = self.op_path / 'report.tsv'
+            stats_file = self.op_path / 'report.stats.tsv'
+            pdf_output = self.op_path / 'report.pdf'
 
             if not report_tsv.exists():
                 self.log_progress("ERROR: DIA-NN report file not found, can't run plotter")
                 return False
 
             command_list = [str(self.diann_plotter), str(stats_file), str(report_tsv), str(pdf_output)]
-            self.log_progress(f"Running DIA-NN plotter: {command_list}")
+            self.log_progress("Running DIA-NN plotter: %s", command_list)
 
             plotter_process = subprocess.Popen(
                 command_list,
@@ -482,12 +636,8 @@ class DIANNHandler:
             )
 
             # Monitor the process
-            while plotter_process.poll() is None:
-                # Check for stop signal
-                if self.check_for_stop_signal(plotter_process):
-                    return False
-
-                time.sleep(1)
+            if not self.wait_for_process(plotter_process):
+                return False
 
             # Check the return code
             if plotter_process.returncode == 0:
@@ -496,7 +646,7 @@ class DIANNHandler:
             else:
                 stdout, stderr = plotter_process.communicate()
                 self.log_progress(f"ERROR: DIA-NN plotter failed with return code {plotter_process.returncode}")
-                self.log_progress(f"Stderr: {stderr}")
+                self.log_progress("Stderr: %s", stderr)
                 return False
 
         except Exception as e:
@@ -505,10 +655,12 @@ class DIANNHandler:
 
     def run_workflow(self):
         """Run the complete DIA-NN workflow"""
+        self.start_progress_thread()
         try:
             # Setup
             self.make_output_folder()
             self.make_output_files()
+            threading.Thread(target=self.watch_sentinel_file, daemon=True).start()
 
             # Process conditions file
             if not self.make_conditions_dict():
@@ -532,15 +684,20 @@ class DIANNHandler:
         except Exception as e:
             self.log_progress(f"ERROR: Unhandled exception in DIA-NN workflow: {str(e)}")
             return False
+        finally:
+            # Stops the sentinel watcher thread
+            self._workflow_done.set()
+            self.stop_progress_thread()
 
 
-def launch_diann_job(job_data, progress_callback=None):
+def launch_diann_job(job_data, progress_callback=None, stop_event=None):
     """
     Launch a DIA-NN job in a separate thread
 
     Args:
         job_data: Dictionary containing all the job parameters
         progress_callback: Function to call with progress updates
+        stop_event: threading.Event that cancels the job when set
     """
     try:
         # Extract parameters from job_data
@@ -551,26 +708,7 @@ def launch_diann_job(job_data, progress_callback=None):
         msconvert_path = job_data.get('msconvert_path')
 
         # Extract DIA-NN parameters
-        params = {
-            'max_missed_cleavage': job_data.get('missed_cleavage', '1'),
-            'max_var_mods': job_data.get('max_var_mods', '2'),
-            'NtermMex_mod': job_data.get('mod_nterm_m_excision', True),
-            'CCarb_mod': job_data.get('mod_c_carb', True),
-            'OxM_mod': job_data.get('mod_ox_m', True),
-            'AcNterm_mod': job_data.get('mod_ac_nterm', False),
-            'Phospho_mod': job_data.get('mod_phospho', False),
-            'KGG_mod': job_data.get('mod_k_gg', False),
-            'peptide_length_range_min': job_data.get('peptide_length_min', '7'),
-            'peptide_length_range_max': job_data.get('peptide_length_max', '30'),
-            'precursor_charge_range_min': job_data.get('precursor_charge_min', '2'),
-            'precursor_charge_range_max': job_data.get('precursor_charge_max', '4'),
-            'precursor_min': job_data.get('precursor_min', '390'),
-            'precursor_max': job_data.get('precursor_max', '1050'),
-            'fragment_min': job_data.get('fragment_min', '200'),
-            'fragment_max': job_data.get('fragment_max', '1800'),
-            'threads': job_data.get('threads', '20'),
-            'MBR': job_data.get('mbr', False),
-        }
+        params = {param: job_data.get(key, default) for param, key, default in DIANN_JOB_PARAMS}
 
         # Log initial message
         if progress_callback:
@@ -584,6 +722,7 @@ def launch_diann_job(job_data, progress_callback=None):
             op_folder=output_folder,
             msconvert_path=msconvert_path,
             progress_callback=progress_callback,
+            stop_event=stop_event,
             **params
         )
 
@@ -601,5 +740,5 @@ def launch_diann_job(job_data, progress_callback=None):
     except Exception as e:
         if progress_callback:
             progress_callback(f"Error in DIA-NN job: {str(e)}")
-        print(f"Error in DIA-NN job: {str(e)}")
+        logger.error(f"Error in DIA-NN job: {str(e)}", exc_info=True)
         return False
\ No newline at end of file
@@ -1,27 +1,121 @@
 """Underlying function for processing of Gel Bands"""
 
 import os
+import re
+import mmap
 import subprocess
 from pathlib import Path
 import shutil
-import copy
-import time
+import stat
 import argparse
 import sys
 import tkinter as tk
 from tkinter import messagebox
 from getpass import getuser
-import fnmatch
+import functools
+import threading
+from collections import deque
+from queue import Empty
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 from lxml import etree
 import psutil
+try:
+    import win32api
+    import win32con
+    import win32job
+    import win32process
+except ImportError:  # pywin32 is only available on Windows
+    win32job = None
+try:
+    import winreg
+except ImportError:
+    winreg = None
 # import openpyxl
 #import fastparquet
 
 #from GelBandIDo_summary_plots_class_jinja import GelBandIDoPlotter
 #from Basepeak_plotter_jinja import *
 
+def read_excel_sheet(path, **kwargs):
+    """Read Sheet1 of an Excel file, using the faster calamine engine when it is installed"""
+    try:
+        return pd.read_excel(path, sheet_name="Sheet1", engine="calamine", **kwargs)
+    except ImportError:
+        return pd.read_excel(path, sheet_name="Sheet1", **kwargs)
+
+@functools.lru_cache(maxsize=8)
+def read_species_dict(database_map, mtime):
+    """Map upper-cased species names to fasta paths from the database map sheet"""
+    df = read_excel_sheet(database_map, usecols=["Species", "Path"])
+    return {species.upper(): path for species, path in zip(df['Species'], df['Path'])}
+
+# Keep MaxQuant/dotnet children from opening a console window on Windows
+SUBPROCESS_CREATION_FLAGS = subprocess.CREATE_NO_WINDOW if sys.platform == 'win32' else 0
+
+# Where the dotnet installer records the host location (key, value)
+DOTNET_REGISTRY_LOCATIONS = (
+    (r"SOFTWARE\dotnet\Setup\InstalledVersions\x64\sharedhost", "Path"),
+    (r"SOFTWARE\dotnet\Setup\InstalledVersions\x64", "InstallLocation"),
+)
+
+# mqpar branches edited for every run, compiled once
+MQ_FASTA_FILES_XPATH = etree.XPath("./fastaFiles")
+MQ_SAMPLE_BRANCHES = (
+    (etree.XPath("./filePaths"), 'string'),
+    (etree.XPath("./experiments"), 'string'),
+    (etree.XPath("./fractions"), 'short'),
+    (etree.XPath("./ptms"), 'boolean'),
+    (etree.XPath("./paramGroupIndices"), 'int'),
+    (etree.XPath("./referenceChannel"), 'string'),
+)
+
+# Header lines of a fasta file, matched on the raw bytes
+FASTA_HEADER_PATTERN = re.compile(rb'^>[^\r\n]*', re.MULTILINE)
+# sendfile() only accepts a regular file as output on Linux
+SENDFILE_SUPPORTED = sys.platform.startswith('linux') and hasattr(os, 'sendfile')
+
+def replace_string_list(branch, values):
+    """Replace the children of an mqpar list element with one <string> per value"""
+    del branch[:]
+    for value in values:
+        etree.SubElement(branch, "string").text = value
+
+def stat_kind(path):
+    """Return 'file', 'dir' or 'other' for an existing path and None otherwise, with a single stat call"""
+    try:
+        mode = os.stat(path).st_mode
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+    if stat.S_ISREG(mode):
+        return 'file'
+    if stat.S_ISDIR(mode):
+        return 'dir'
+    return 'other'
+
+def find_file(folder, file_name, max_depth):
+    """Return the path of file_name under folder, descending at most max_depth levels"""
+    try:
+        entries = list(os.scandir(folder))
+    except OSError:
+        return None
+    for entry in entries:
+        if entry.name == file_name and entry.is_file():
+            return entry.path
+    if max_depth > 0:
+        for entry in entries:
+            if entry.is_dir():
+                found = find_file(entry.path, file_name, max_depth - 1)
+                if found is not None:
+                    return found
+    return None
+
 class MaxQuant_handler:
+    # Lines of MaxQuant stderr kept for the error report
+    STDERR_TAIL_LINES = 200
+    # Smaller fasta runs are cheaper to write from the mapped file than to flush and sendfile
+    SENDFILE_MIN_BYTES = 64 * 1024
+
     def __init__(self, stop_queue, progress_queue,
                  MQ_version, MQ_path, db_map,
                  fasta_folder, output_folder, conditions, dbs, user_input_params,
@@ -75,31 +169,49 @@ class MaxQuant_handler:
         self.run_mode = run_mode
 
         self.error_flag = False
-        self.stop_requested = False
+        # Set once a STOP message has been read from stop_queue
+        self.stop_event = threading.Event()
         
-        # Define file extensions
-        self.fasta_extensions = ['.fa', '.FA', '.fasta', '.FASTA', '.faa', '.FAA']
+        # Define file extensions (matched case-insensitively)
+        self.fasta_extensions = {'.fa', '.fasta', '.faa'}
         
-        self.sentinel_file_path = Path(self.output_folder) / "stop_requested.sentinel"
-        self.conditions_dict = self.make_conditions_dict()
+        # Conditions, species map and fasta folder are only read when first needed
         self.raw_folder = raw_folder
-        self.get_common_parent_directory()
-        self.species_dict = self.load_species_dict()
-        self.database_paths = self.get_species_filepaths()
 
         db_string = ('_').join(self.dbs)
         self.master_fasta = Path(self.fasta_folder) / 'merged_fasta_folder' / f'custom_fasta_merged_w_{db_string.upper()}_database.fasta'
-        self.MQ_op_folder = Path(self.raw_folder) / "combined/"
         self.temp_op_folder = Path(self.output_folder) / 'TEMP'
-        self.temp_op_folder.mkdir(exist_ok=True)
-        self.fasta_files = self.get_files_with_extensions()
 
-        self.AppData_path = str(self.get_AppData_path())
+        self.AppData_path = self.get_AppData_path()
+        self.process_job = self.create_process_job()
+
+    @functools.cached_property
+    def conditions_dict(self):
+        return self.make_conditions_dict()
+
+    @functools.cached_property
+    def species_dict(self):
+        return self.load_species_dict()
+
+    @functools.cached_property
+    def database_paths(self):
+        return self.get_species_filepaths()
+
+    @functools.cached_property
+    def fasta_files(self):
+        return self.get_files_with_extensions()
+
+    def prepare_run(self):
+        # Work that needs the conditions file or touches the disk, deferred from __init__
+        self.get_common_parent_directory()
+        self.MQ_op_folder = Path(self.raw_folder) / "combined/"
+        self.temp_op_folder.mkdir(exist_ok=True)
 
     def validate_MQ_path(self):
-        if not os.path.exists(self.MQ_path):
+        kind = stat_kind(self.MQ_path)
+        if kind is None:
             raise FileNotFoundError(f"The provided MaxQuant path {self.MQ_path} does not exist.")
-        if not os.path.isfile(self.MQ_path):
+        if kind != 'file':
             raise ValueError(f"The provided MaxQuant path {self.MQ_path} is not a file.")
     
     def get_AppData_path(self):
@@ -120,16 +232,14 @@ class MaxQuant_handler:
             os.makedirs(results_op)
         return Path(results_op)
 
-    def sentinel_file_exists(self):
-        return os.path.exists(self.sentinel_file_path)
-
     def make_conditions_dict(self):
         try:
-            ext = os.path.splitext(str(Path(self.conditions)))[1]
+            conditions_path = Path(self.conditions)
+            ext = conditions_path.suffix
             if ext == ".xlsx":
-                conditions_df = pd.read_excel(Path(self.conditions), sheet_name="Sheet1", dtype = str)
+                conditions_df = read_excel_sheet(conditions_path, dtype = str)
             elif ext == ".txt" or ext == ".tsv":
-                conditions_df = pd.read_csv(Path(self.conditions), sep="\t", dtype = str)
+                conditions_df = pd.read_csv(conditions_path, sep="\t", dtype = str)
             else:
                 print("Please use a file in excel or tab-delimited format.")
                 return None
@@ -139,28 +249,26 @@ class MaxQuant_handler:
         
         # Add a 'Basename' column to the dataframe
         print(conditions_df)
-        conditions_df['Basename'] = conditions_df['Raw file path'].apply(lambda x: os.path.basename(str(Path(x))))
+        raw_paths = conditions_df['Raw file path'].astype(str)
+        basenames = raw_paths.str.replace(r'.*[\\/]', '', regex=True)
+        conditions_df['Basename'] = basenames
 
         # Add column for mzML files
         self.converted_op = Path(self.output_folder) / "mzML_files"
-        conditions_df['mzML file'] = conditions_df['Raw file path'].apply(lambda x: str(self.converted_op / str(os.path.basename(os.path.splitext(x)[0])+ '.mzML')))
-        
-        # Convert the dataframe to a dictionary with 'raw_file' as keys
-        conditions_dict = {}
-        for _, row in conditions_df.iterrows():
-            raw_file = row['Basename']
-            conditions_dict[raw_file] = row.drop('Basename').to_dict()
-        return conditions_dict
+        mzML_prefix = os.fspath(self.converted_op) + os.sep
+        stems = basenames.str.replace(r'\.[^.]*$', '', regex=True)
+        conditions_df['mzML file'] = mzML_prefix + stems + '.mzML'
+
+        # Convert the dataframe to a dictionary with 'raw_file' as keys. On duplicates the last
+        # row's values win but the key keeps its first position, as with plain dict assignment
+        first_seen_order = conditions_df['Basename'].drop_duplicates()
+        conditions_df = conditions_df.drop_duplicates(subset='Basename', keep='last').set_index('Basename')
+        return conditions_df.reindex(first_seen_order).to_dict(orient='index')
 
     # Define function to map species to file location
     def load_species_dict(self):
-        # Load the file into a dataframe
-        df = pd.read_excel(self.database_map, sheet_name="Sheet1")
-    
-        # Convert species names to lowercase and create dictionary
-        species_dict = {row['Species'].upper(): row['Path'] for _, row in df.iterrows()}
-    
-        return species_dict
+        # Keyed on the file's mtime so handlers for later jobs reuse the parsed map until it is edited
+        return dict(read_species_dict(str(self.database_map), os.path.getmtime(self.database_map)))
 
     def get_species_filepaths(self):
         # Convert input to uppercase and fetch the filepath
@@ -183,12 +291,10 @@ class MaxQuant_handler:
                 raise ValueError("Multiple parent directories found!")
 
     def get_files_with_extensions(self):
-        files = []
-        folder=Path(self.fasta_folder)
-        for extension in self.fasta_extensions:
-            files.extend(folder.glob(f'*{extension}'))
-        files=list(set(files))
-        return files
+        # One directory pass instead of a glob per extension
+        with os.scandir(self.fasta_folder) as entries:
+            return [Path(entry.path) for entry in entries
+                    if entry.is_file() and os.path.splitext(entry.name)[1].lower() in self.fasta_extensions]
 
 
     def show_error_message(self, message, retry_callback=None):
@@ -209,16 +315,96 @@ class MaxQuant_handler:
             # For now, just exit
             self.error_flag = True
 
+    @property
+    def stop_requested(self):
+        return self.stop_event.is_set()
+
+    def handle_stop_message(self, message):
+        if message.startswith("STOP"):
+            self.stop_event.set()
+            self.progress_queue.put("UPDATE: Stop requested")
+
     def check_stop_queue(self):
-        if not self.stop_queue.empty():
-            message = self.stop_queue.get()
-            if message.startswith("STOP"):
-                self.stop_requested = True
-                self.progress_queue.put("UPDATE: Stop requested")
+        # Drain everything queued so far so stale control messages don't pile up
+        while True:
+            try:
+                message = self.stop_queue.get_nowait()
+            except Empty:
+                break
+            self.handle_stop_message(message)
+
+    def wait_unless_cancelled(self, process):
+        """Wait for a short-lived process, killing it on a stop or error; False if it was killed
+
+        Safe to call from a worker thread: it doesn't clean up or exit, that
+        is left to check_and_terminate_if_sentinel_exists on the main thread.
+        The output pipes are assumed small enough not to fill before exit.
+        """
+        while process.poll() is None:
+            # Wakes as soon as a stop message arrives instead of sleeping out the interval
+            if self.wait_for_stop(timeout=1) or self.error_flag:
+                self.terminate_process_tree(process.pid)
+                process.communicate()
+                return False
+        return True
+
+    def wait_for_stop(self, timeout):
+        """Block on stop_queue for up to timeout seconds and return whether a stop was requested"""
+        try:
+            self.handle_stop_message(self.stop_queue.get(timeout=timeout))
+        except Empty:
+            pass
+        return self.stop_requested
 
 
 
+    def create_process_job(self):
+        """Job object that is killed together with every MaxQuant process in it (None off Windows)"""
+        if win32job is None:
+            return None
+        job = win32job.CreateJobObject(None, "")
+        limits = win32job.QueryInformationJobObject(job, win32job.JobObjectExtendedLimitInformation)
+        limits['BasicLimitInformation']['LimitFlags'] = win32job.JOB_OBJECT_LIMIT_KILL_ON_JOB_CLOSE
+        win32job.SetInformationJobObject(job, win32job.JobObjectExtendedLimitInformation, limits)
+        return job
+
+    def launch_process(self, command_list, stdout=subprocess.PIPE):
+        if self.process_job is None:
+            return subprocess.Popen(
+                command_list, stdout=stdout, stderr=subprocess.PIPE, text=True,
+                creationflags=SUBPROCESS_CREATION_FLAGS)
+
+        # Start suspended so MaxQuant can't spawn children before it is in the job;
+        # children started afterwards inherit the job, so the whole tree can be killed at once
+        process = subprocess.Popen(
+            command_list, stdout=stdout, stderr=subprocess.PIPE, text=True,
+            creationflags=SUBPROCESS_CREATION_FLAGS | win32process.CREATE_SUSPENDED)
+        try:
+            handle = win32api.OpenProcess(
+                win32con.PROCESS_TERMINATE | win32con.PROCESS_SET_QUOTA, False, process.pid)
+            try:
+                win32job.AssignProcessToJobObject(self.process_job, handle)
+            finally:
+                win32api.CloseHandle(handle)
+        except Exception as e:
+            # terminate_process_tree falls back to walking the tree for processes outside the job
+            print(f"Could not add process {process.pid} to the job object: {e}")
+        try:
+            psutil.Process(process.pid).resume()
+        except psutil.Error as e:
+            # Never leave a suspended child behind; Popen holds its own handle to kill it with
+            process.kill()
+            process.communicate()
+            raise RuntimeError(f"Could not resume {command_list[0]} (PID {process.pid}) after starting it: {e}") from e
+        return process
+
     def terminate_process_tree(self, pid):
+        if self.process_job is not None:
+            print(f"Terminating job object holding process with PID: {pid}")
+            win32job.TerminateJobObject(self.process_job, 1)
+            # Anything the job didn't hold is still reachable through the process tree
+            if not psutil.pid_exists(pid):
+                return
         try:
             parent = psutil.Process(pid)
             print(f"Attempting to terminate parent process with PID: {parent.pid}")
@@ -241,11 +427,12 @@ class MaxQuant_handler:
         def attempt_cleanup():
             dir_path_obj = Path(directory_path)
             try:
-                if dir_path_obj.exists() and dir_path_obj.is_dir():
+                kind = stat_kind(dir_path_obj)
+                if kind == 'dir':
                     shutil.rmtree(dir_path_obj)
                     print(f"Removing folder and all files in {directory_path}.")
                     return True
-                elif not dir_path_obj.exists():
+                elif kind is None:
                     print(f"Directory doesn't exist: {directory_path}")
                     return True
                     
@@ -267,7 +454,7 @@ class MaxQuant_handler:
         def attempt_cleanup():
             file_path_obj = Path(file_path)
             try:
-                if file_path_obj.exists() and file_path_obj.is_file():
+                if stat_kind(file_path_obj) == 'file':
                     file_path_obj.unlink()
                     print(f"Removing file {file_path}.")
                     return True
@@ -287,67 +474,98 @@ class MaxQuant_handler:
 
     def check_and_terminate_if_sentinel_exists(self):
         self.check_stop_queue()
-        if self.stop_requested or self.error_flag:
-        #if self.stop_requested:
-            if self.error_flag:
-                self.progress_queue.put("UPDATE: GelBandIDo encountered\n an error")
-            else:
-                self.progress_queue.put("UPDATE: Cancelling GelBandIDo")
-            # Perform cleanup operations
-            # Remove results folder and all contents
-            if hasattr(self, 'results_op'):
-                self.cleanup_directory(self.results_op)
-                
-            if hasattr(self, 'temp_op_folder'):
-                self.cleanup_directory(self.temp_op_folder)
+        # Nothing to clean up on the happy path
+        if not (self.stop_requested or self.error_flag):
+            return
 
-            # Remove updated mqpar file
-            if hasattr(self, 'win_MQ_params_updated'):
-                self.cleanup_file(str(self.win_MQ_params_updated))   
-
-            # Remove temporary mqpar file
-            if hasattr(self, 'temp_MQ_params'):
-                self.cleanup_file(self.temp_MQ_params) 
-
-            # Remove only UNFINISHED mqpar
-            if hasattr(self, 'MQ_op_folder'):
-                if Path(self.MQ_op_folder).exists():
-                    run_times_file = Path(self.MQ_op_folder) / 'proc' / '#runningTimes.txt'
-                    try:
-                        with open(run_times_file, 'r') as f:
-                            lines = f.readlines()
-                            # Get the last line
-                            last_line = lines[-1].strip()
-                            # Check if the last line contains the string "Finish writing tables"
-                            if "Finish writing tables" not in last_line:
-                                self.cleanup_directory(self.MQ_op_folder)
-                            else:
-                                print("Found completed MaxQuant folder--not deleting.")
-                    except FileNotFoundError:
-                        if Path(self.MQ_op_folder) / 'txt' / 'allPeptides.txt' == False:
+        if self.error_flag:
+            self.progress_queue.put("UPDATE: GelBandIDo encountered\n an error")
+        else:
+            self.progress_queue.put("UPDATE: Cancelling GelBandIDo")
+        # Perform cleanup operations
+        # Remove results folder and all contents
+        if hasattr(self, 'results_op'):
+            self.cleanup_directory(self.results_op)
+            
+        if hasattr(self, 'temp_op_folder'):
+            self.cleanup_directory(self.temp_op_folder)
+
+        # Remove updated mqpar file
+        if hasattr(self, 'win_MQ_params_updated'):
+            self.cleanup_file(str(self.win_MQ_params_updated))   
+
+        # Remove temporary mqpar file
+        if hasattr(self, 'temp_MQ_params'):
+            self.cleanup_file(self.temp_MQ_params) 
+
+        # Remove only UNFINISHED mqpar
+        if hasattr(self, 'MQ_op_folder'):
+            if Path(self.MQ_op_folder).exists():
+                run_times_file = Path(self.MQ_op_folder) / 'proc' / '#runningTimes.txt'
+                try:
+                    with open(run_times_file, 'r') as f:
+                        lines = f.readlines()
+                        # Get the last line
+                        last_line = lines[-1].strip()
+                        # Check if the last line contains the string "Finish writing tables"
+                        if "Finish writing tables" not in last_line:
                             self.cleanup_directory(self.MQ_op_folder)
                         else:
                             print("Found completed MaxQuant folder--not deleting.")
+                except FileNotFoundError:
+                    if Path(self.MQ_op_folder) / 'txt' / 'allPeptides.txt' == False:
+                        self.cleanup_directory(self.MQ_op_folder)
+                    else:
+                        print("Found completed MaxQuant folder--not deleting.")
+
+        print("Sentinel file detected. Terminating script.")
+        if self.error_flag:
+            self.progress_queue.put("PROCESS CANCELLED: GelBandIDo cancelled due to unrecoverable errors.")
+        else:
+            self.progress_queue.put("PROCESS CANCELLED: GelBandIDo cancelled.")
+        sys.exit()
+
+    def get_dotnet_path(self):
+        # PATH first, then the location recorded by the dotnet installer
+        self.dotnet_path = shutil.which("dotnet") or self.get_registry_dotnet_path()
+        if self.dotnet_path is None:
+            # Last resort: a shallow look inside the known install folders only
+            for search_folder in self.get_dotnet_search_folders():
+                self.dotnet_path = find_file(search_folder, "dotnet.exe", max_depth=2)
+                if self.dotnet_path is not None:
+                    break
+        print(self.dotnet_path)
+        return self.dotnet_path
+
+    def get_dotnet_search_folders(self):
+        search_folders = [os.path.join(program_files, 'dotnet')
+                          for program_files in (os.getenv('ProgramFiles'), os.getenv('ProgramFiles(x86)'))
+                          if program_files]
+        # Per-user installs, which are often missing from PATH
+        if self.AppData_path:
+            search_folders.append(os.path.join(self.AppData_path, 'Local', 'Microsoft', 'dotnet'))
+        user_profile = os.getenv('USERPROFILE')
+        if user_profile:
+            search_folders.append(os.path.join(user_profile, '.dotnet'))
+        # Lab machines keep portable installs on the software drive
+        search_folders.append('D:\\Software')
+        return search_folders
+
+    def get_registry_dotnet_path(self):
+        if winreg is None:
+            return None
+        for key_path, value_name in DOTNET_REGISTRY_LOCATIONS:
+            try:
+                with winreg.OpenKey(winreg.HKEY_LOCAL_MACHINE, key_path, 0,
+                                    winreg.KEY_READ | winreg.KEY_WOW64_32KEY) as key:
+                    install_folder = winreg.QueryValueEx(key, value_name)[0]
+            except OSError:
+                continue
+            dotnet_exe = os.path.join(install_folder, "dotnet.exe")
+            if os.path.isfile(dotnet_exe):
+                return dotnet_exe
+        return None
 
-            print("Sentinel file detected. Terminating script.")
-            if self.error_flag:
-                self.progress_queue.put("PROCESS CANCELLED: GelBandIDo cancelled due to unrecoverable errors.")
-            else:
-                self.progress_queue.put("PROCESS CANCELLED: GelBandIDo cancelled.")
-            sys.exit()
-
-    def get_dotnet_path(self, search_folders):
-        for folder in search_folders:
-            for root, dirnames, filenames in os.walk(folder):
-                dirnames[:] = [d for d in dirnames if d not in ["Users", "$Recycle.Bin", "Windows", "ProgramData", "Spectronaut", "KNIME"]]
-                dirnames[:] = [d for d in dirnames if not fnmatch.fnmatch(d, '*Spectronaut*')]
-                dirnames[:] = [d for d in dirnames if not fnmatch.fnmatch(d, '*KNIME*')]
-                for filename in filenames:
-                    if filename == "dotnet.exe":
-                        self.dotnet_path = os.path.join(root, filename)
-                        print(self.dotnet_path)
-                        return self.dotnet_path
-            
     def concatenate_fasta_files(self):
         self.progress_queue.put("STARTING: Concatenating input and database fasta.")
         try:
@@ -357,42 +575,18 @@ class MaxQuant_handler:
             else:
                 # Initialize a set to keep track of unique identifiers
                 seen_identifiers = set()
-                with Path(self.master_fasta).open('w') as output_file:
-                    # First, process fasta_files to ensure they take priority
-                    for fasta_file in self.fasta_files:
-                        with Path(fasta_file).open() as input_file:
-                            write_sequence = False
-                            for line in input_file:
-                                if line.startswith('>'):  # This is an identifier line
-                                    identifier = line.strip()
-                                    # Check if this identifier has already been seen
-                                    if identifier not in seen_identifiers:
-                                        seen_identifiers.add(identifier)
-                                        write_sequence = True
-                                    else:
-                                        write_sequence = False
-                                if write_sequence and line.strip():
-                                    output_file.write(line)
-                                    if not line.endswith('\n'):
-                                        output_file.write('\n')
-                    
-                    # Then, process database_paths, skipping already seen identifiers
-                    for fasta_file in self.database_paths:
-                        with Path(fasta_file).open() as input_file:
-                            write_sequence = False
-                            for line in input_file:
-                                if line.startswith('>'):  # This is an identifier line
-                                    identifier = line.strip()
-                                    # Check if this identifier has already been seen
-                                    if identifier not in seen_identifiers:
-                                        seen_identifiers.add(identifier)
-                                        write_sequence = True
-                                    else:
-                                        write_sequence = False
-                                if write_sequence and line.strip():
-                                    output_file.write(line)
-                                    if not line.endswith('\n'):
-                                        output_file.write('\n')
+                with Path(self.master_fasta).open('wb') as output_file:
+                    # fasta_files come first so they take priority over database_paths
+                    for fasta_file in [*self.fasta_files, *self.database_paths]:
+                        # Runs on a worker thread: only watch for a stop here, the main thread cleans up
+                        self.check_stop_queue()
+                        if self.stop_requested or self.error_flag:
+                            break
+                        self.append_unique_fasta_records(fasta_file, output_file, seen_identifiers)
+                if self.stop_requested or self.error_flag:
+                    # A partial merge would be reused as complete by the next run
+                    Path(self.master_fasta).unlink()
+                    return
 
             self.progress_queue.put("STEP COMPLETED: Files concatenated.")
 
@@ -402,6 +596,49 @@ class MaxQuant_handler:
 
 
 
+    def append_unique_fasta_records(self, fasta_file, output_file, seen_identifiers):
+        """Copy the records of fasta_file whose header line hash is not in seen_identifiers
+
+        Headers are located with one regex pass over the mapped file and runs of
+        consecutive new records are written as single byte slices, rather than
+        handling the file line by line in Python.
+        """
+        with Path(fasta_file).open('rb') as input_file:
+            if os.fstat(input_file.fileno()).st_size == 0:
+                return
+            with mmap.mmap(input_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                run_start = None
+                for header in FASTA_HEADER_PATTERN.finditer(data):
+                    # Only the 64-bit hash of each header is kept, not the header bytes
+                    identifier = hash(header.group().strip())
+                    if identifier not in seen_identifiers:
+                        seen_identifiers.add(identifier)
+                        if run_start is None:
+                            run_start = header.start()
+                    elif run_start is not None:
+                        self.write_fasta_run(output_file, input_file, data, run_start, header.start())
+                        run_start = None
+                if run_start is not None:
+                    self.write_fasta_run(output_file, input_file, data, run_start, len(data))
+
+    def write_fasta_run(self, output_file, input_file, data, start, end):
+        end_byte = data[end - 1]
+        if SENDFILE_SUPPORTED and end - start >= self.SENDFILE_MIN_BYTES:
+            # Let the kernel copy large runs (typically whole files) without passing through Python
+            output_file.flush()
+            try:
+                while start < end:
+                    sent = os.sendfile(output_file.fileno(), input_file.fileno(), start, end - start)
+                    if sent == 0:
+                        break
+                    start += sent
+            except OSError:
+                pass
+        if start < end:
+            output_file.write(data[start:end])
+        if end_byte != ord('\n'):
+            output_file.write(b'\n')
+
     def create_MaxQuant_par(self):
         self.progress_queue.put(
             f"STARTING: Creating template MaxQuant params file (v{self.MQ_version})."
@@ -419,24 +656,21 @@ class MaxQuant_handler:
                 
                 self.MQ_params = Path(self.temp_op_folder) / new_MQ_params_name
 
-                process_0 = subprocess.Popen(
-                [self.MQ_path, '--create',  str(self.MQ_params)],
-                stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, shell=True)
+                process_0 = self.launch_process(
+                    [self.MQ_path, '--create',  str(self.MQ_params)])
+                if not self.wait_unless_cancelled(process_0):
+                    return
                 result_stdout, result_stderr = process_0.communicate()
                 print(result_stderr)
                 if ".NET Core" in result_stderr:
                     print("MQ couldn't find dotnet for create folder. Retry with search for dotnet.")
                     self.progress_queue.put("UPDATE: MQ couldn't find dotnet.\nRetry with search for dotnet.")
-                    process_0 = subprocess.Popen(
-                    [self.get_dotnet_path(['D:\\Software', 'C:\\', self.AppData_path]),
-                    self.MQ_path, '--create',  str(self.MQ_params)],
-                    stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, shell=True)
-
-                while process_0.poll() is None:
-                    self.check_and_terminate_if_sentinel_exists()
-                    time.sleep(2)
-
-                result_stdout, result_stderr = process_0.communicate()
+                    process_0 = self.launch_process(
+                    [self.get_dotnet_path(),
+                    self.MQ_path, '--create',  str(self.MQ_params)])
+                    if not self.wait_unless_cancelled(process_0):
+                        return
+                    result_stdout, result_stderr = process_0.communicate()
 
                 if process_0.returncode != 0:
                     print("MaxQuant --create encountered an error.")
@@ -466,7 +700,7 @@ class MaxQuant_handler:
             root = tree.getroot()
 
             # Editing fasta location
-            fastaFile_block = root.find("./fastaFiles")
+            fastaFile_block = MQ_FASTA_FILES_XPATH(root)[0]
 
             for child in list(fastaFile_block)[1:]:
                 fastaFile_block.remove(child)
@@ -476,16 +710,6 @@ class MaxQuant_handler:
             fasta_path.text = os.path.basename(self.master_fasta)
 
             # Editing raw files and corresponding attributes
-            branch_names = ["./filePaths", "./experiments", "./fractions", "./ptms", "./paramGroupIndices", "./referenceChannel"]
-            branch_list = [root.find(branch_name) for branch_name in branch_names]
-
-            for branch in branch_list:
-                for child in list(branch)[1:]:
-                    branch.remove(child)
-
-            child_tags = ['string', 'string', 'short', 'boolean', 'int', 'string']
-            child_list = [branch.find(tag) for tag, branch in zip(child_tags, branch_list)]
-
             ET_raw_files = list(self.conditions_dict.keys())
             experiments_list = [details['Experiment'] for details in self.conditions_dict.values()]
             common_length = len(self.conditions_dict)
@@ -496,14 +720,12 @@ class MaxQuant_handler:
 
             par_text_lists = [ET_raw_files, experiments_list, fractions, ptms, pGIs, refChannels]
 
-            for i, new_par_texts in enumerate(zip(*par_text_lists)):
-                for par_child, new_par_text in zip(child_list, new_par_texts):
-                    if i > 0:
-                        new_dupe = copy.deepcopy(par_child)
-                        new_dupe.text = new_par_text
-                        branch_list[child_list.index(par_child)].append(new_dupe)
-                    else:
-                        par_child.text = new_par_text
+            # One fresh element per raw file in each branch, rather than deep copies of the template entry
+            for (branch_xpath, child_tag), new_par_texts in zip(MQ_SAMPLE_BRANCHES, par_text_lists):
+                branch = branch_xpath(root)[0]
+                del branch[:]
+                for new_par_text in new_par_texts:
+                    etree.SubElement(branch, child_tag).text = new_par_text
             # Ensure AllPeptides table is produced!
             all_peps_branch = root.find("./writeAllPeptidesTable")
             all_peps_branch.text = "True"
@@ -523,29 +745,13 @@ class MaxQuant_handler:
                     if missed_cleavage_branch is not None:
                         missed_cleavage_branch.text = str(self.num_missed_cleavages)
 
-                    # Fixed modifications
-                    ## self.fixed_mods
-                    fixed_mod_branches = param_group.findall("fixedModifications")
-                    for fixed_mod_branch in fixed_mod_branches:
-                        # Remove existing fixed modifications if needed
-                        for child in list(fixed_mod_branch):
-                            fixed_mod_branch.remove(child)
-                        # Add new fixed modifications
-                        for new_fixed_mod in self.fixed_mods:
-                            new_fixed_mod_elem = etree.SubElement(fixed_mod_branch, "string")
-                            new_fixed_mod_elem.text = new_fixed_mod
-
-                    # Enzymes
-                    ## self.enzymes(list)
-                    enzymes_branches = param_group.findall("enzymes")
-                    for enzymes_branch in enzymes_branches:
-                        # Remove existing fixed modifications if needed
-                        for child in list(enzymes_branch):
-                            enzymes_branch.remove(child)
-                        # Add new fixed modifications
-                        for new_enzyme in self.enzymes:
-                            new_enzyme_elem = etree.SubElement(enzymes_branch, "string")
-                            new_enzyme_elem.text = new_enzyme
+                    # Fixed modifications, enzymes, first search enzymes and var modifications
+                    for list_tag, new_values in (("fixedModifications", self.fixed_mods),
+                                                 ("enzymes", self.enzymes),
+                                                 ("enzymesFirstSearch", self.fs_enzymes),
+                                                 ("variableModifications", self.var_mods)):
+                        for list_branch in param_group.iterchildren(list_tag):
+                            replace_string_list(list_branch, new_values)
 
                     # Use enzymes first search
                     ## self.use_enzyme_first_search_str
@@ -553,30 +759,6 @@ class MaxQuant_handler:
                     if use_enzyme_first_search_branch is not None:
                         use_enzyme_first_search_branch.text = str(self.use_enzyme_first_search_str)
 
-                    # First search enzymes 
-                    ## self.fs_enzymes(list)
-                    fs_enzymes_branches = param_group.findall("enzymesFirstSearch")
-                    for fs_enzymes_branch in fs_enzymes_branches:
-                        # Remove existing fixed modifications if needed
-                        for child in list(fs_enzymes_branch):
-                            fs_enzymes_branch.remove(child)
-                        # Add new fixed modifications
-                        for new_fs_enzyme in self.fs_enzymes:
-                            new_fs_enzyme_elem = etree.SubElement(fs_enzymes_branch, "string")
-                            new_fs_enzyme_elem.text = new_fs_enzyme
-
-                    # Var modifications
-                    ## self.var_mods
-                    var_mod_branches = param_group.findall("variableModifications")
-                    for var_mod_branch in var_mod_branches:
-                        # Remove existing fixed modifications if needed
-                        for child in list(var_mod_branch):
-                            var_mod_branch.remove(child)
-                        # Add new fixed modifications
-                        for new_var_mod in self.var_mods:
-                            new_var_mod_elem = etree.SubElement(var_mod_branch, "string")
-                            new_var_mod_elem.text = new_var_mod
-
 
                 
                 # Editing parse rules
@@ -603,13 +785,12 @@ class MaxQuant_handler:
                 numThreads = root.find("./numThreads")
                 numThreads.text = str(self.num_threads)
 
-            et = etree.ElementTree(root)
             #self.temp_MQ_params = Path(self.output_folder, os.path.basename(str(Path(self.MQ_params))).split('.xml')[0] + '_temp.xml')
             file_str = Path(self.MQ_params).name.replace('.xml','_temp.xml')
             self.progress_queue.put(f"TEMP: {file_str}")
             self.temp_MQ_params = Path(self.temp_op_folder) / file_str
             self.progress_queue.put(f"TEMP: {self.temp_MQ_params}")
-            et.write(str(self.temp_MQ_params), pretty_print=True)
+            tree.write(str(self.temp_MQ_params), encoding='utf-8', xml_declaration=True)
             self.progress_queue.put(
                 "STEP COMPLETED: Edited MaxQuant params file."
             )
@@ -639,21 +820,18 @@ class MaxQuant_handler:
                 self.win_MQ_params_updated.unlink()
 
             # Start changeFolder subprocess
-            process_1 = subprocess.Popen(
-                [
-                self.MQ_path, str(self.temp_MQ_params), '--changeFolder', str(self.win_MQ_params_updated), str(master_folder), str(self.raw_folder)],
-                stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, shell=True)
+            process_1 = self.launch_process(
+                [self.MQ_path, str(self.temp_MQ_params), '--changeFolder', str(self.win_MQ_params_updated), str(master_folder), str(self.raw_folder)])
             result_stdout, result_stderr = process_1.communicate()
             if process_1.returncode != 0:
                 if ".NET Core" in result_stderr:
                     print("MQ couldn't find dotnet. Retry with search for dotnet.")
                     self.progress_queue.put("UPDATE: MQ couldn't find dotnet.\nRetry with search for dotnet.")
-                    self.dotnet_path = self.get_dotnet_path(['D:\\Software', 'C:\\', self.AppData_path])
+                    self.dotnet_path = self.get_dotnet_path()
                     self.progress_queue.put(self.dotnet_path)
-                    process_1 = subprocess.Popen(
+                    process_1 = self.launch_process(
                     [self.dotnet_path,
-                    self.MQ_path, str(self.temp_MQ_params), '--changeFolder', str(self.win_MQ_params_updated), str(master_folder), str(self.raw_folder)],
-                    stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, shell=True)
+                    self.MQ_path, str(self.temp_MQ_params), '--changeFolder', str(self.win_MQ_params_updated), str(master_folder), str(self.raw_folder)])
                     result_stdout, result_stderr = process_1.communicate()
         
             if process_1.returncode == 0:
@@ -677,10 +855,8 @@ class MaxQuant_handler:
             # If change folder ran with dotnet path, assume the same here                    
 
             # Start search subprocess
-            process_test = subprocess.Popen(
-                [
-                self.MQ_path, '--dryrun', str(self.win_MQ_params_updated)],
-                stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, shell=True)
+            process_test = self.launch_process(
+                [self.MQ_path, '--dryrun', str(self.win_MQ_params_updated)])
             print(f"Started MaxQuant dryrun subprocess with PID: {process_test.pid}")
             self.progress_queue.put("UPDATE: Running dry run of MQ to assess dotnet.")                     
             result_stdout, result_stderr = process_test.communicate()
@@ -689,36 +865,37 @@ class MaxQuant_handler:
                 if ".NET Core" in result_stderr:
                     print("MQ couldn't find dotnet. Retry with search for dotnet.")
                     self.progress_queue.put("UPDATE: MQ couldn't find dotnet.\nRetry with search for dotnet.")
-                    self.dotnet_path = self.get_dotnet_path(['D:\\Software', 'C:\\', self.AppData_path])
+                    self.dotnet_path = self.get_dotnet_path()
                     self.progress_queue.put(self.dotnet_path)
                     command_list = [self.dotnet_path,self.MQ_path, str(self.win_MQ_params_updated)]
             else:
                 command_list = [self.MQ_path, str(self.win_MQ_params_updated)]
             
-            process_2 = subprocess.Popen(
-                command_list, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, shell=True
-                )
+            # MaxQuant's stdout is never reported, and only the end of stderr is worth keeping
+            process_2 = self.launch_process(command_list, stdout=subprocess.DEVNULL)
             print(f"Started MaxQuant subprocess with PID: {process_2.pid}")
+            stderr_tail = deque(maxlen=self.STDERR_TAIL_LINES)
+            stderr_reader = threading.Thread(target=stderr_tail.extend, args=(process_2.stderr,), daemon=True)
+            stderr_reader.start()
 
             # Periodically check if the sentinel file exists while the subprocess is running
             while True:
-                if process_2.poll() is not None:
-                    print("Process 2 has ended.")
-                    break
-                self.check_stop_queue()
-                if self.stop_requested:
+                if self.wait_for_stop(timeout=1):
                     print("Stop request detected during Process 2.")
                     self.terminate_external_processes(process_2)
                     break
-                time.sleep(2)
+                if process_2.poll() is not None:
+                    print("Process 2 has ended.")
+                    break
 
-            result_stdout, result_stderr = process_2.communicate()
-            print("Communicate command executed after Process 2.")
+            process_2.wait()
+            stderr_reader.join()
+            process_2.stderr.close()
+            result_stderr = ''.join(stderr_tail)
+            print("Collected output of Process 2.")
 
             if process_2.returncode == 0:
                 print("MaxQuant Search ran successfully.")
-                print("Standard Output:")
-                print(result_stdout)
                 self.progress_queue.put(
                     f"STEP COMPLETED: Ran MaxQuant version {self.MQ_version}."
                 )
@@ -744,10 +921,15 @@ class MaxQuant_handler:
 
     def run_MaxQuant_cli(self):
         try:
+            self.prepare_run()
             self.check_and_terminate_if_sentinel_exists()
-            self.concatenate_fasta_files()
-            self.check_and_terminate_if_sentinel_exists()
-            self.create_MaxQuant_par()
+            # The template params file doesn't need the merged fasta, so build both at once
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                concatenation = executor.submit(self.concatenate_fasta_files)
+                params_creation = executor.submit(self.create_MaxQuant_par)
+                concatenation.result()
+                params_creation.result()
+            # Handles a stop request as well as an error flagged by either step
             self.check_and_terminate_if_sentinel_exists()
             self.edit_MQ_par()
             self.check_and_terminate_if_sentinel_exists()